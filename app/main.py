@@ -1,25 +1,52 @@
 from fastapi import FastAPI, HTTPException
 from prometheus_fastapi_instrumentator import Instrumentator
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from fastapi.responses import Response
+from prometheus_client import Histogram, generate_latest, CONTENT_TYPE_LATEST
+from fastapi.responses import ORJSONResponse, Response
+import asyncio
+import logging
 import time
 import random
 import os
+import orjson
+from contextlib import asynccontextmanager
 
 # OpenTelemetry imports
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.semconv.resource import ResourceAttributes
 
+# Log through uvicorn's configured logger so startup messages are visible
+logger = logging.getLogger("uvicorn.error")
+
 # Custom metrics
-REQUEST_COUNT = Counter('app_requests_total', 'Total number of requests', ['method', 'endpoint'])
-REQUEST_DURATION = Histogram('app_request_duration_seconds', 'Duration of requests')
+REQUEST_DURATION = Histogram(
+    'app_request_duration_seconds',
+    'Duration of requests',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf")),
+)
+
+# Encoded /custom-metrics payload, regenerated at most once per TTL
+_METRICS_TTL = float(os.getenv("METRICS_CACHE_TTL", "1.0"))
+_metrics_cache = {"ts": float("-inf"), "body": b""}
+_metrics_lock = asyncio.Lock()
+
+# Pre-encoded bodies for endpoints whose response never changes
+_ROOT_BODY = orjson.dumps({"message": "Hello World! This is a FastAPI app with metrics."})
+_SIMULATE_ERROR_OK_BODY = orjson.dumps({"message": "Success! No error this time."})
+
+# Set SIMULATE_LATENCY=0 to skip the artificial delays, e.g. when benchmarking
+_SIMULATE = os.getenv("SIMULATE_LATENCY", "1") == "1"
+
+# Dedicated RNG for the simulated latencies, with its methods pre-bound
+_rng = random.Random()
+_uniform = _rng.uniform
+_randint = _rng.randint
+_random = _rng.random
 
 # Configure OpenTelemetry
 def configure_tracing():
@@ -30,78 +57,102 @@ def configure_tracing():
         ResourceAttributes.SERVICE_INSTANCE_ID: os.getenv("HOSTNAME", "fastapi-local"),
     })
     
+    # Sample a fraction of new traces at the root; children follow their parent
+    sampler = ParentBased(TraceIdRatioBased(float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "0.01"))))
+    
     # Create tracer provider
-    trace.set_tracer_provider(TracerProvider(resource=resource))
+    trace.set_tracer_provider(TracerProvider(resource=resource, sampler=sampler))
     tracer_provider = trace.get_tracer_provider()
     
-    # Configure Jaeger exporter
-    jaeger_exporter = JaegerExporter(
-        agent_host_name=os.getenv("JAEGER_AGENT_HOST", "jaeger"),
-        agent_port=int(os.getenv("JAEGER_AGENT_PORT", "6831")),
+    # Configure OTLP exporter; the collector fans spans out to Jaeger
+    otlp_exporter = OTLPSpanExporter(
+        endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://otel-collector:4317"),
+        insecure=True,
     )
     
-    # Add span processor
-    span_processor = BatchSpanProcessor(jaeger_exporter)
+    # Add span processor; a deeper queue and shorter delay absorb bursts without dropping spans
+    bsp_settings = {
+        "max_queue_size": int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "8192")),
+        "schedule_delay_millis": int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "2000")),
+        "max_export_batch_size": int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "1024")),
+        "export_timeout_millis": int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000")),
+    }
+    span_processor = BatchSpanProcessor(otlp_exporter, **bsp_settings)
     tracer_provider.add_span_processor(span_processor)
+    logger.info("BatchSpanProcessor settings: %s", bsp_settings)
     
     # Get tracer
     return trace.get_tracer(__name__)
 
-# Initialize tracing
-tracer = configure_tracing()
+# Proxy tracer until configure_tracing() installs the real provider at startup
+tracer = trace.get_tracer(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up tracing once per worker process and flush pending spans on shutdown"""
+    global tracer
+    tracer = configure_tracing()
+    yield
+    trace.get_tracer_provider().shutdown()
 
 app = FastAPI(
     title="FastAPI Observability Demo",
     description="A FastAPI application with Prometheus metrics and distributed tracing",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
-# Initialize Prometheus instrumentator
-instrumentator = Instrumentator()
+# Initialize Prometheus instrumentator; it provides http_requests_total per handler
+instrumentator = Instrumentator(
+    should_group_status_codes=True,
+    should_ignore_untemplated=True,
+    excluded_handlers=["/custom-metrics", "/metrics"],
+)
 instrumentator.instrument(app).expose(app)
 
 # Initialize OpenTelemetry automatic instrumentation
 FastAPIInstrumentor.instrument_app(app)
-HTTPXClientInstrumentor().instrument()
-RequestsInstrumentor().instrument()
 
 @app.get("/")
 async def root():
     """Root endpoint"""
-    REQUEST_COUNT.labels(method="GET", endpoint="/").inc()
-    return {"message": "Hello World! This is a FastAPI app with metrics."}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    REQUEST_COUNT.labels(method="GET", endpoint="/health").inc()
     return {"status": "healthy", "timestamp": time.time()}
 
 @app.get("/api/users/{user_id}")
 async def get_user(user_id: int):
     """Get user by ID - simulates database call"""
-    start_time = time.time()
-    REQUEST_COUNT.labels(method="GET", endpoint="/api/users/{user_id}").inc()
+    start_time = time.perf_counter()
     
     # Create custom span for database simulation
     with tracer.start_as_current_span("simulate_database_query") as span:
-        span.set_attribute("user.id", user_id)
-        span.set_attribute("db.operation", "select")
-        span.set_attribute("db.table", "users")
+        # Unsampled spans are no-ops; skip building their attributes entirely
+        recording = span.is_recording()
+        if recording:
+            span.set_attribute("user.id", user_id)
+            span.set_attribute("db.operation", "select")
+            span.set_attribute("db.table", "users")
         
         # Simulate some processing time
-        processing_time = random.uniform(0.1, 0.5)
-        span.set_attribute("db.duration_ms", processing_time * 1000)
-        time.sleep(processing_time)
+        if _SIMULATE:
+            await asyncio.sleep(_uniform(0.1, 0.5))
         
         if user_id == 404:
-            span.set_attribute("error", True)
-            span.set_attribute("error.message", "User not found")
+            if recording:
+                span.set_attribute("error", True)
+                span.set_attribute("error.message", "User not found")
             raise HTTPException(status_code=404, detail="User not found")
         
-        span.set_attribute("user.found", True)
+        if recording:
+            span.set_attribute("user.found", True)
     
-    REQUEST_DURATION.observe(time.time() - start_time)
+    processing_time = time.perf_counter() - start_time
+    REQUEST_DURATION.observe(processing_time)
     
     return {
         "user_id": user_id,
@@ -113,32 +164,40 @@ async def get_user(user_id: int):
 @app.post("/api/users")
 async def create_user():
     """Create a new user - simulates user creation"""
-    start_time = time.time()
-    REQUEST_COUNT.labels(method="POST", endpoint="/api/users").inc()
-    
-    new_user_id = random.randint(1000, 9999)
+    start_time = time.perf_counter()
     
-    # Create custom span for user validation
-    with tracer.start_as_current_span("validate_user_data") as validation_span:
-        validation_span.set_attribute("user.id", new_user_id)
-        validation_time = random.uniform(0.05, 0.15)
-        time.sleep(validation_time)
-        validation_span.set_attribute("validation.duration_ms", validation_time * 1000)
-        validation_span.set_attribute("validation.passed", True)
+    new_user_id = _randint(1000, 9999)
     
-    # Create custom span for database insertion
-    with tracer.start_as_current_span("database_insert") as db_span:
-        db_span.set_attribute("user.id", new_user_id)
-        db_span.set_attribute("db.operation", "insert")
-        db_span.set_attribute("db.table", "users")
+    # One span covers validation and insertion; the steps are recorded as events
+    with tracer.start_as_current_span("create_user") as span:
+        recording = span.is_recording()
+        if recording:
+            span.set_attribute("db.operation", "insert")
+            span.set_attribute("db.table", "users")
+        
+        # Simulate user validation
+        if recording:
+            span.add_event("validate.start")
+        validation_attrs = {}
+        if _SIMULATE:
+            validation_time = _uniform(0.05, 0.15)
+            await asyncio.sleep(validation_time)
+            validation_attrs["duration_ms"] = validation_time * 1000
+        if recording:
+            span.add_event("validate.end", validation_attrs)
         
         # Simulate database processing time
-        db_processing_time = random.uniform(0.15, 0.65)
-        time.sleep(db_processing_time)
-        db_span.set_attribute("db.duration_ms", db_processing_time * 1000)
-        db_span.set_attribute("db.rows_affected", 1)
+        if recording:
+            span.add_event("db_insert.start")
+        db_attrs = {}
+        if _SIMULATE:
+            db_processing_time = _uniform(0.15, 0.65)
+            await asyncio.sleep(db_processing_time)
+            db_attrs["duration_ms"] = db_processing_time * 1000
+        if recording:
+            span.add_event("db_insert.end", db_attrs)
     
-    processing_time = time.time() - start_time
+    processing_time = time.perf_counter() - start_time
     REQUEST_DURATION.observe(processing_time)
     
     return {
@@ -152,18 +211,24 @@ async def create_user():
 @app.get("/api/simulate-error")
 async def simulate_error():
     """Endpoint to simulate errors for testing"""
-    REQUEST_COUNT.labels(method="GET", endpoint="/api/simulate-error").inc()
     
     # Randomly generate errors
-    if random.random() < 0.3:  # 30% chance of error
+    if _random() < 0.3:  # 30% chance of error
         raise HTTPException(status_code=500, detail="Simulated internal server error")
     
-    return {"message": "Success! No error this time."}
+    return Response(content=_SIMULATE_ERROR_OK_BODY, media_type="application/json")
 
 @app.get("/custom-metrics")
 async def custom_metrics():
     """Expose custom metrics in Prometheus format"""
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    if time.monotonic() - _metrics_cache["ts"] > _METRICS_TTL:
+        async with _metrics_lock:
+            # Another request may have refreshed the cache while we waited
+            now = time.monotonic()
+            if now - _metrics_cache["ts"] > _METRICS_TTL:
+                _metrics_cache["body"] = generate_latest()
+                _metrics_cache["ts"] = now
+    return Response(_metrics_cache["body"], media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
@@ -4,6 +4,7 @@ Test script to generate traffic for FastAPI monitoring demo.
 This script helps test the monitoring setup by making requests to various endpoints.
 """
 
+import array
 import asyncio
 import httpx
 import random
@@ -11,6 +12,7 @@ import time
 from typing import List
 
 BASE_URL = "http://localhost:8000"
+CLIENT_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
 
 async def test_endpoint(client: httpx.AsyncClient, endpoint: str, method: str = "GET", **kwargs):
     """Test a single endpoint and return response info."""
@@ -36,19 +38,33 @@ async def test_endpoint(client: httpx.AsyncClient, endpoint: str, method: str =
             "success": False
         }
 
-async def generate_traffic(duration_seconds: int = 60, requests_per_second: int = 2):
+async def _periodic_report(counters: array.array, start_time: float, interval: float = 1.0):
+    """Print progress from the shared (total, success) counters until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        total_requests, successful_requests = counters
+        elapsed = time.time() - start_time
+        rate = total_requests / elapsed if elapsed > 0 else 0
+        success_rate = (successful_requests / total_requests) * 100 if total_requests > 0 else 0
+        
+        print(f"⏱️  {elapsed:.1f}s | 📈 {rate:.1f} req/s | ✅ {success_rate:.1f}% success | Total: {total_requests}")
+
+async def generate_traffic(client: httpx.AsyncClient, duration_seconds: int = 60, requests_per_second: int = 2):
     """Generate traffic to the FastAPI application."""
     
-    endpoints = [
-        ("/", "GET"),
-        ("/health", "GET"),
-        ("/api/users/123", "GET"),
-        ("/api/users/456", "GET"),
-        ("/api/users/789", "GET"),
-        ("/api/users/404", "GET"),  # This will generate 404 errors
-        ("/api/users", "POST"),
-        ("/api/simulate-error", "GET"),  # This will generate random errors
+    # (path, method, relative frequency); error paths are kept rare
+    traffic_mix = [
+        ("/", "GET", 1),
+        ("/health", "GET", 1),
+        ("/api/users/123", "GET", 5),
+        ("/api/users/456", "GET", 5),
+        ("/api/users/789", "GET", 5),
+        ("/api/users/404", "GET", 1),  # This will generate 404 errors
+        ("/api/users", "POST", 3),
+        ("/api/simulate-error", "GET", 2),  # This will generate random errors
     ]
+    endpoints = [(path, method) for path, method, _ in traffic_mix]
+    weights = [weight for _, _, weight in traffic_mix]
     
     print(f"🚀 Starting traffic generation for {duration_seconds} seconds")
     print(f"📊 Target: {requests_per_second} requests per second")
@@ -56,33 +72,40 @@ async def generate_traffic(duration_seconds: int = 60, requests_per_second: int
     print("-" * 50)
     
     start_time = time.time()
-    total_requests = 0
-    successful_requests = 0
-    
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        while time.time() - start_time < duration_seconds:
-            # Select random endpoint
-            endpoint, method = random.choice(endpoints)
-            
-            # Make request
+    # (total, successful) request counts, updated by index in the request tasks
+    counters = array.array('Q', [0, 0])
+    
+    # Requests are fired on schedule rather than awaited in turn, so the offered
+    # rate does not drop when the server is slow; the semaphore caps in-flight work
+    sem = asyncio.Semaphore(max(1, int(requests_per_second * 4)))
+    tasks: List[asyncio.Task] = []
+    
+    async def _bounded(endpoint: str, method: str):
+        async with sem:
             result = await test_endpoint(client, endpoint, method)
-            total_requests += 1
-            
-            if result["success"]:
-                successful_requests += 1
-            
-            # Print progress every 10 requests
-            if total_requests % 10 == 0:
-                elapsed = time.time() - start_time
-                rate = total_requests / elapsed if elapsed > 0 else 0
-                success_rate = (successful_requests / total_requests) * 100 if total_requests > 0 else 0
-                
-                print(f"⏱️  {elapsed:.1f}s | 📈 {rate:.1f} req/s | ✅ {success_rate:.1f}% success | Total: {total_requests}")
-            
-            # Sleep to control rate
-            await asyncio.sleep(1.0 / requests_per_second)
+        counters[0] += 1
+        counters[1] += result["success"]
+    
+    # Progress is reported on a timer, off the per-request path
+    reporter = asyncio.create_task(_periodic_report(counters, start_time))
+    
+    # Sample the whole run's endpoint sequence up front
+    plan = random.choices(endpoints, weights=weights, k=int(duration_seconds * requests_per_second) + 8)
+    
+    for endpoint, method in plan:
+        if time.time() - start_time >= duration_seconds:
+            break
+        
+        # Sleep to control rate
+        await asyncio.sleep(1.0 / requests_per_second)
+        tasks.append(asyncio.create_task(_bounded(endpoint, method)))
+    
+    # Wait for in-flight requests before reporting
+    await asyncio.gather(*tasks)
+    reporter.cancel()
     
     # Final statistics
+    total_requests, successful_requests = counters
     elapsed = time.time() - start_time
     actual_rate = total_requests / elapsed if elapsed > 0 else 0
     success_rate = (successful_requests / total_requests) * 100 if total_requests > 0 else 0
@@ -98,7 +121,7 @@ async def generate_traffic(duration_seconds: int = 60, requests_per_second: int
     print(f"Actual rate: {actual_rate:.1f} requests/second")
     print("=" * 50)
 
-async def test_all_endpoints():
+async def test_all_endpoints(client: httpx.AsyncClient):
     """Test all endpoints once to verify they're working."""
     print("🔍 Testing all endpoints...")
     
@@ -112,58 +135,58 @@ async def test_all_endpoints():
         ("/custom-metrics", "GET"),
     ]
     
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        for endpoint, method in endpoints:
-            result = await test_endpoint(client, endpoint, method)
-            status_icon = "✅" if result["success"] else "❌"
-            print(f"{status_icon} {method:4} {endpoint:20} -> {result['status']}")
+    for endpoint, method in endpoints:
+        result = await test_endpoint(client, endpoint, method)
+        status_icon = "✅" if result["success"] else "❌"
+        print(f"{status_icon} {method:4} {endpoint:20} -> {result['status']}")
 
 async def main():
     """Main function to run the test script."""
     print("FastAPI Monitoring Test Script")
     print("=" * 40)
     
-    # Test if the API is running
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{BASE_URL}/health")
+    # One client (and connection pool) is shared by every request in the run
+    async with httpx.AsyncClient(timeout=10.0, limits=CLIENT_LIMITS) as client:
+        # Test if the API is running
+        try:
+            response = await client.get(f"{BASE_URL}/health", timeout=5.0)
             if response.status_code == 200:
                 print("✅ FastAPI is running!")
             else:
                 print(f"⚠️  FastAPI returned status {response.status_code}")
-    except Exception as e:
-        print(f"❌ Cannot connect to FastAPI at {BASE_URL}")
-        print(f"Error: {e}")
-        print("\nMake sure FastAPI is running:")
-        print("docker-compose up --build")
-        return
-    
-    print("\nChoose an option:")
-    print("1. Test all endpoints once")
-    print("2. Generate light traffic (1 req/s for 30s)")
-    print("3. Generate moderate traffic (2 req/s for 60s)")
-    print("4. Generate heavy traffic (5 req/s for 120s)")
-    print("5. Custom traffic generation")
-    
-    choice = input("\nEnter your choice (1-5): ").strip()
-    
-    if choice == "1":
-        await test_all_endpoints()
-    elif choice == "2":
-        await generate_traffic(duration_seconds=30, requests_per_second=1)
-    elif choice == "3":
-        await generate_traffic(duration_seconds=60, requests_per_second=2)
-    elif choice == "4":
-        await generate_traffic(duration_seconds=120, requests_per_second=5)
-    elif choice == "5":
-        try:
-            duration = int(input("Duration in seconds: "))
-            rate = float(input("Requests per second: "))
-            await generate_traffic(duration_seconds=duration, requests_per_second=rate)
-        except ValueError:
-            print("❌ Invalid input. Please enter valid numbers.")
-    else:
-        print("❌ Invalid choice.")
+        except Exception as e:
+            print(f"❌ Cannot connect to FastAPI at {BASE_URL}")
+            print(f"Error: {e}")
+            print("\nMake sure FastAPI is running:")
+            print("docker-compose up --build")
+            return
+    
+        print("\nChoose an option:")
+        print("1. Test all endpoints once")
+        print("2. Generate light traffic (1 req/s for 30s)")
+        print("3. Generate moderate traffic (2 req/s for 60s)")
+        print("4. Generate heavy traffic (5 req/s for 120s)")
+        print("5. Custom traffic generation")
+    
+        choice = input("\nEnter your choice (1-5): ").strip()
+    
+        if choice == "1":
+            await test_all_endpoints(client)
+        elif choice == "2":
+            await generate_traffic(client, duration_seconds=30, requests_per_second=1)
+        elif choice == "3":
+            await generate_traffic(client, duration_seconds=60, requests_per_second=2)
+        elif choice == "4":
+            await generate_traffic(client, duration_seconds=120, requests_per_second=5)
+        elif choice == "5":
+            try:
+                duration = int(input("Duration in seconds: "))
+                rate = float(input("Requests per second: "))
+                await generate_traffic(client, duration_seconds=duration, requests_per_second=rate)
+            except ValueError:
+                print("❌ Invalid input. Please enter valid numbers.")
+        else:
+            print("❌ Invalid choice.")
     
     print("\n🎉 Test completed!")
     print("📊 Check your monitoring dashboards:")